@@ -1,22 +1,123 @@
+import os
+
+# Async mode must be chosen (and the stdlib patched) before anything else is imported
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'eventlet')  # eventlet | threading
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE != 'threading':
+    raise ValueError(f'Unsupported ASYNC_MODE {ASYNC_MODE!r} (use eventlet or threading)')
+
 from flask import Flask, request
 from flask_socketio import SocketIO, emit, join_room, leave_room
-import random
-import os
+import atexit
+import base64
+import heapq
+import json
+import logging
+import logging.handlers
+import orjson
+import queue
+import secrets
+import re
+import sys
+import threading
 import time
-from threading import RLock
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from threading import Lock, RLock
+
+
+class OrjsonCodec:
+    """orjson behind the stdlib json interface expected by python-socketio"""
+    
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        # Output is already compact, so separators etc. are ignored
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            # e.g. lone surrogates relayed from a client payload
+            return json.dumps(obj, separators=(',', ':'))
+    
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # orjson rejects some input the stdlib accepts (e.g. lone surrogate escapes)
+            return json.loads(s)
+
+
+@dataclass(slots=True)
+class User:
+    """A connected user; the same object is shared by user_data and its room"""
+    sid: str
+    username: str
+    room_code: str
+    joined_at: int  # time.monotonic_ns()
+    muted: bool = False
+    
+    def to_payload(self):
+        """Client-facing representation (existingUsers entries)"""
+        return {'username': self.username, 'socketId': self.sid, 'muted': self.muted}
+
+
+@dataclass(slots=True)
+class Room:
+    created_at: int  # time.monotonic_ns(), like all server-side timestamps
+    last_activity: int
+    users: dict = field(default_factory=dict)  # { sid: User }
+    names: dict = field(default_factory=dict)  # { username_lower: sid }
+    roster: list = None  # cached existingUsers payload, None when stale
+
+
+class StripWebSocketExtensions:
+    """WSGI middleware hiding client-offered WebSocket extensions, so permessage-deflate is never negotiated"""
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        environ.pop('HTTP_SEC_WEBSOCKET_EXTENSIONS', None)
+        return self.wsgi_app(environ, start_response)
+
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'rip-chat-secret-key'
 
-socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=20, ping_interval=10)
+socketio = SocketIO(app, async_mode=ASYNC_MODE, json=OrjsonCodec,
+                    http_compression=False,  # signaling payloads are small: compression costs more than it saves
+                    cors_allowed_origins="*", ping_timeout=20, ping_interval=10)
+
+# Same for WebSocket frames: wraps the Socket.IO middleware, so it sees the upgrade request first
+app.wsgi_app = StripWebSocketExtensions(app.wsgi_app)
 
-# Thread lock for data safety (RLock allows same thread to acquire multiple times)
-data_lock = RLock()
+# Striped room locks: a room is guarded by room_lock(room_code), so unrelated rooms
+# never contend; a sid in no room is guarded by room_lock(sid). RLock allows same
+# thread to acquire multiple times.
+LOCK_STRIPES = 64  # must be a power of two
+room_lock_stripes = [RLock() for _ in range(LOCK_STRIPES)]
+# Makes the MAX_ROOMS check + insert atomic across stripes (taken inside room locks, never the reverse)
+room_count_lock = Lock()
 
 # Data structures
-rooms = {}  # { room_code: { users: {}, created_at: timestamp, last_activity: timestamp } }
-user_data = {}  # { sid: { username, room_code, joined_at } }
-rate_limits = {}  # { sid: { last_action: timestamp, action_count: int } }
+rooms = {}  # { room_code: Room }
+user_data = {}  # { sid: User }
+rate_limits = {}  # { sid: (last_action_ns << RATE_COUNT_BITS) | action_count }
+
+# Room expirations: one live entry per room, re-pushed if the room saw activity since
+room_expiry_heap = []  # min-heap of ( expires_at, room_code, created_at )
+room_expiry_lock = Lock()
+last_rate_limit_sweep = 0
+
+# Flat indexes for the signaling hot path (kept in sync with rooms/user_data)
+sid_room = {}  # { sid: room_code } - room codes are interned, so same-room is an identity check
+room_members = {}  # { room_code: set(sid) }
+
+# ICE candidates waiting for the next batch flush
+pending_ice = {}  # { target_sid: [ { candidate, fromId } ] }
+ice_lock = Lock()
 
 # Configuration
 MAX_USERS_PER_ROOM = 10
@@ -25,21 +126,86 @@ MAX_USERNAME_LENGTH = 20
 MIN_USERNAME_LENGTH = 1
 RATE_LIMIT_WINDOW = 5  # seconds
 RATE_LIMIT_MAX_ACTIONS = 10  # max actions per window
+RATE_LIMIT_WINDOW_NS = RATE_LIMIT_WINDOW * 1_000_000_000
+RATE_COUNT_BITS = 8  # low bits of a rate_limits entry hold the action count (saturates)
+RATE_COUNT_MASK = (1 << RATE_COUNT_BITS) - 1
 ROOM_INACTIVE_TIMEOUT = 3600  # 1 hour - cleanup inactive rooms
-ALLOWED_USERNAME_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_- ")
-
-
-def log(message):
-    """Timestamped logging"""
-    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-    print(f'[{timestamp}] {message}')
+ROOM_INACTIVE_TIMEOUT_NS = ROOM_INACTIVE_TIMEOUT * 1_000_000_000
+ICE_BATCH_INTERVAL = 0.01  # seconds - coalescing window for ice-candidate forwards
+# Room codes: base32 output re-mapped onto an alphabet without 0/1/I/O (32 chars, 1:1)
+ROOM_CODE_TRANSLATION = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567', b'ABCDEFGHJKLMNPQRSTUVWXYZ23456789')
+USERNAME_PATTERN = re.compile(r'[A-Za-z0-9_\- ]+')  # allowed characters, used with fullmatch
+
+
+# Timestamped logging: handlers only enqueue records, a listener thread does the writes.
+# Under eventlet the listener must be a real OS thread with an unpatched queue, otherwise
+# its blocking stdout writes would run on the hub and stall every connection.
+if ASYNC_MODE == 'eventlet':
+    log_threading = eventlet.patcher.original('threading')
+    log_queue = eventlet.patcher.original('queue').Queue()
+else:
+    log_threading = threading
+    log_queue = queue.Queue()
+
+
+class OSThreadQueueListener(logging.handlers.QueueListener):
+    """QueueListener draining on a log_threading (real OS) thread"""
+    
+    def start(self):
+        self._thread = log_threading.Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+
+
+logger = logging.getLogger('rip-chat')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+log_stream_handler = logging.StreamHandler(sys.stdout)  # stdout, like the print() it replaced
+log_stream_handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+log_listener = OSThreadQueueListener(log_queue, log_stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)  # flush pending records on exit
+
+
+def room_lock(room_code):
+    """Lock guarding the state of one room"""
+    return room_lock_stripes[hash(room_code) & (LOCK_STRIPES - 1)]
+
+
+@contextmanager
+def room_locks(*room_codes):
+    """Hold the locks of several rooms, acquired in a fixed order to avoid deadlock"""
+    locks = sorted({room_lock(code) for code in room_codes if code}, key=id)
+    for lock in locks:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
+@contextmanager
+def user_room_locks(sid, *room_codes):
+    """Hold the locks of room_codes and of sid's current room; yields that room code (None if in none)"""
+    # user_data[sid] only changes under its current room's lock (sid's own stripe when in no room),
+    # so re-check it once locked and retry if the user moved in the meantime
+    while True:
+        user = user_data.get(sid)
+        current_code = user.room_code if user else None
+        with room_locks(current_code or sid, *room_codes):
+            user = user_data.get(sid)
+            if (user.room_code if user else None) == current_code:
+                yield current_code
+                return
 
 
 def generate_room_code():
     """Generate unique 6-character room code"""
-    chars = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
     for _ in range(100):  # Max attempts
-        code = ''.join(random.choice(chars) for _ in range(6))
+        # 4 random bytes -> 6 base32 chars (30 bits), one RNG call per code
+        code = base64.b32encode(secrets.token_bytes(4))[:6].translate(ROOM_CODE_TRANSLATION).decode()
         if code not in rooms:
             return code
     return None  # Failed to generate unique code
@@ -61,7 +227,7 @@ def sanitize_username(username):
         username = username[:MAX_USERNAME_LENGTH]
     
     # Check for valid characters
-    if not all(c in ALLOWED_USERNAME_CHARS for c in username):
+    if not USERNAME_PATTERN.fullmatch(username):
         return None, "Username contains invalid characters"
     
     # Check if it's just whitespace
@@ -76,85 +242,108 @@ def is_username_taken(room_code, username, exclude_sid=None):
     if room_code not in rooms:
         return False
     
-    for sid, user in rooms[room_code]['users'].items():
-        if sid != exclude_sid and user['username'].lower() == username.lower():
-            return True
-    return False
+    owner = rooms[room_code].names.get(username.lower())
+    return owner is not None and owner != exclude_sid
 
 
-def check_rate_limit(sid):
+def check_rate_limit(sid, now):
     """Check if user is rate limited. Returns (is_limited, message)"""
-    current_time = time.time()
-    
-    if sid not in rate_limits:
-        rate_limits[sid] = {'last_action': current_time, 'action_count': 1}
-        return False, None
-    
-    user_rate = rate_limits[sid]
+    user_rate = rate_limits.get(sid)
     
-    # Reset if outside window
-    if current_time - user_rate['last_action'] > RATE_LIMIT_WINDOW:
-        rate_limits[sid] = {'last_action': current_time, 'action_count': 1}
+    # Start a new window if none yet or outside window
+    if user_rate is None or now - (user_rate >> RATE_COUNT_BITS) > RATE_LIMIT_WINDOW_NS:
+        rate_limits[sid] = (now << RATE_COUNT_BITS) | 1
         return False, None
     
     # Increment and check
-    user_rate['action_count'] += 1
-    user_rate['last_action'] = current_time
+    action_count = min((user_rate & RATE_COUNT_MASK) + 1, RATE_COUNT_MASK)
+    rate_limits[sid] = (now << RATE_COUNT_BITS) | action_count
     
-    if user_rate['action_count'] > RATE_LIMIT_MAX_ACTIONS:
+    if action_count > RATE_LIMIT_MAX_ACTIONS:
         return True, "Too many actions. Please slow down."
     
     return False, None
 
 
-def cleanup_rate_limits():
-    """Remove old rate limit entries"""
-    current_time = time.time()
-    to_remove = [sid for sid, data in rate_limits.items() 
-                 if current_time - data['last_action'] > RATE_LIMIT_WINDOW * 2]
+def cleanup_rate_limits(now):
+    """Remove old rate limit entries (sweeps at most once per window)"""
+    global last_rate_limit_sweep
+    if now - last_rate_limit_sweep < RATE_LIMIT_WINDOW_NS:
+        return
+    last_rate_limit_sweep = now
+    
+    cutoff = now - RATE_LIMIT_WINDOW_NS * 2
+    to_remove = [sid for sid, user_rate in list(rate_limits.items())
+                 if user_rate >> RATE_COUNT_BITS < cutoff]
     for sid in to_remove:
-        del rate_limits[sid]
+        rate_limits.pop(sid, None)
 
 
-def cleanup_inactive_rooms():
-    """Remove rooms that have been inactive"""
-    current_time = time.time()
-    to_remove = []
-    
-    for room_code, room in rooms.items():
-        # Remove if empty
-        if len(room['users']) == 0:
-            to_remove.append(room_code)
-        # Remove if inactive for too long
-        elif current_time - room['last_activity'] > ROOM_INACTIVE_TIMEOUT:
-            to_remove.append(room_code)
-    
-    for room_code in to_remove:
-        del rooms[room_code]
-        log(f'Room {room_code} cleaned up (empty or inactive)')
+def schedule_room_expiry(room_code, room):
+    """Queue room to be checked for inactivity once its timeout could have passed"""
+    with room_expiry_lock:
+        heapq.heappush(room_expiry_heap,
+                       (room.last_activity + ROOM_INACTIVE_TIMEOUT_NS, room_code, room.created_at))
+
+
+def cleanup_inactive_rooms(now):
+    """Remove rooms that have been inactive - only visits rooms whose expiry is due"""
+    while True:
+        with room_expiry_lock:
+            # >= (not >): a room re-pushed below expires exactly at `now` when its inactivity
+            # equals the timeout, and must not be popped again in this call
+            if not room_expiry_heap or room_expiry_heap[0][0] >= now:
+                return
+            _, room_code, created_at = heapq.heappop(room_expiry_heap)
+        
+        with room_lock(room_code):
+            room = rooms.get(room_code)
+            # Entry belongs to a room that was already deleted (code may have been reused)
+            if room is None or room.created_at != created_at:
+                continue
+            
+            # Active since the entry was pushed: check again at its new expiry
+            if len(room.users) > 0 and now - room.last_activity <= ROOM_INACTIVE_TIMEOUT_NS:
+                schedule_room_expiry(room_code, room)
+                continue
+            
+            for sid in room_members.pop(room_code, ()):
+                sid_room.pop(sid, None)
+            del rooms[room_code]
+            logger.info(f'Room {room_code} cleaned up (empty or inactive)')
 
 
-def update_room_activity(room_code):
+def update_room_activity(room_code, now):
     """Update last activity timestamp for room"""
     if room_code in rooms:
-        rooms[room_code]['last_activity'] = time.time()
+        rooms[room_code].last_activity = now
+
+
+def get_room_roster(room):
+    """existingUsers payload for room, cached until a user leaves or changes mute (joins append to it)"""
+    if room.roster is None:
+        room.roster = [user.to_payload() for user in room.users.values()]
+    return room.roster
 
 
-def handle_user_leave(sid, notify=True):
+def handle_user_leave(sid, now, notify=True):
     """Handle user leaving - used by disconnect and leave-room"""
-    with data_lock:
-        if sid not in user_data:
+    with user_room_locks(sid) as room_code:
+        if room_code is None:
             return
         
-        username = user_data[sid]['username']
-        room_code = user_data[sid]['room_code']
+        username = user_data[sid].username
         
-        log(f'User leaving: {username} from room {room_code}')
+        logger.info(f'User leaving: {username} from room {room_code}')
         
         if room_code and room_code in rooms:
             # Remove user from room
-            if sid in rooms[room_code]['users']:
-                del rooms[room_code]['users'][sid]
+            room = rooms[room_code]
+            if sid in room.users:
+                del room.users[sid]
+                room.names.pop(username.lower(), None)
+                room.roster = None
+            room_members[room_code].discard(sid)
             
             # Notify others if requested
             if notify:
@@ -167,21 +356,51 @@ def handle_user_leave(sid, notify=True):
             leave_room(room_code)
             
             # Update activity or delete if empty
-            if len(rooms[room_code]['users']) == 0:
+            if len(room.users) == 0:
                 del rooms[room_code]
-                log(f'Room {room_code} deleted (empty)')
+                del room_members[room_code]
+                logger.info(f'Room {room_code} deleted (empty)')
             else:
-                update_room_activity(room_code)
-                log(f'Room {room_code} now has {len(rooms[room_code]["users"])} user(s)')
+                update_room_activity(room_code, now)
+                logger.info(f'Room {room_code} now has {len(room.users)} user(s)')
         
         # Clean up user data
         del user_data[sid]
+        sid_room.pop(sid, None)
         
         # Clean up rate limits
         if sid in rate_limits:
             del rate_limits[sid]
 
 
+def flush_ice_candidates():
+    """Background task: after one batch window, forward queued ICE candidates per target"""
+    global pending_ice
+    socketio.sleep(ICE_BATCH_INTERVAL)
+    
+    with ice_lock:
+        batches, pending_ice = pending_ice, {}
+    
+    for target_id, candidates in batches.items():
+        # A lone candidate keeps the plain event, so clients without batch support still work
+        if len(candidates) == 1:
+            socketio.emit('ice-candidate', candidates[0], to=target_id)
+        else:
+            socketio.emit('ice-candidate-batch', candidates, to=target_id)
+
+
+def queue_ice_candidate(target_id, payload):
+    """Queue an ICE candidate, scheduling a one-shot flush if none is pending"""
+    with ice_lock:
+        if not pending_ice:
+            socketio.start_background_task(flush_ice_candidates)
+        
+        if target_id in pending_ice:
+            pending_ice[target_id].append(payload)
+        else:
+            pending_ice[target_id] = [payload]
+
+
 def get_room_info(room_code):
     """Get room info for status updates"""
     if room_code not in rooms:
@@ -190,9 +409,9 @@ def get_room_info(room_code):
     room = rooms[room_code]
     return {
         'code': room_code,
-        'userCount': len(room['users']),
-        'users': [{'username': u['username'], 'muted': u['muted']} 
-                  for u in room['users'].values()]
+        'userCount': len(room.users),
+        'users': [{'username': u.username, 'muted': u.muted}
+                  for u in room.users.values()]
     }
 
 
@@ -200,25 +419,28 @@ def get_room_info(room_code):
 
 @socketio.on('connect')
 def handle_connect():
-    log(f'User connected: {request.sid}')
+    logger.info(f'User connected: {request.sid}')
     # Periodic cleanup on new connections
-    cleanup_inactive_rooms()
-    cleanup_rate_limits()
+    now = time.monotonic_ns()
+    cleanup_inactive_rooms(now)
+    cleanup_rate_limits(now)
 
 
 @socketio.on('disconnect')
 def handle_disconnect():
     sid = request.sid
-    log(f'User disconnected: {sid}')
-    handle_user_leave(sid, notify=True)
+    now = time.monotonic_ns()
+    logger.info(f'User disconnected: {sid}')
+    handle_user_leave(sid, now, notify=True)
 
 
 @socketio.on('create-room')
 def handle_create_room(username):
     sid = request.sid
+    now = time.monotonic_ns()
     
     # Rate limit check
-    is_limited, limit_msg = check_rate_limit(sid)
+    is_limited, limit_msg = check_rate_limit(sid, now)
     if is_limited:
         emit('error', limit_msg)
         return
@@ -229,43 +451,47 @@ def handle_create_room(username):
         emit('error', error)
         return
     
-    with data_lock:
-        # Check max rooms
-        if len(rooms) >= MAX_ROOMS:
-            emit('error', 'Server is full. Please try again later.')
-            return
-        
-        # Leave current room if in one
-        if sid in user_data:
-            handle_user_leave(sid, notify=True)
-        
-        # Generate room code
-        room_code = generate_room_code()
-        if not room_code:
+    # Check max rooms (fast path, re-checked atomically below)
+    if len(rooms) >= MAX_ROOMS:
+        emit('error', 'Server is full. Please try again later.')
+        return
+    
+    # Generate room code
+    room_code = generate_room_code()
+    if not room_code:
+        emit('error', 'Could not create room. Please try again.')
+        return
+    room_code = sys.intern(room_code)
+    
+    # Also hold the lock of the room we may be leaving
+    with user_room_locks(sid, room_code) as current_code:
+        # Another create may have claimed the same code meanwhile
+        if room_code in rooms:
             emit('error', 'Could not create room. Please try again.')
             return
         
-        current_time = time.time()
+        # Create room, unless concurrent creates filled the server meanwhile
+        room = Room(now, now)
+        with room_count_lock:
+            if len(rooms) >= MAX_ROOMS:
+                emit('error', 'Server is full. Please try again later.')
+                return
+            
+            # Leave current room only now that the create can no longer fail
+            if current_code is not None:
+                handle_user_leave(sid, now, notify=True)
+            
+            rooms[room_code] = room
         
-        # Create room
-        rooms[room_code] = {
-            'users': {
-                sid: {
-                    'username': username,
-                    'socketId': sid,
-                    'muted': False
-                }
-            },
-            'created_at': current_time,
-            'last_activity': current_time
-        }
+        user = User(sid, username, room_code, now)
+        room.users[sid] = user
+        room.names[username.lower()] = sid
         
         # Track user
-        user_data[sid] = {
-            'username': username,
-            'room_code': room_code,
-            'joined_at': current_time
-        }
+        user_data[sid] = user
+        room_members[room_code] = {sid}
+        sid_room[sid] = room_code
+        schedule_room_expiry(room_code, room)
         
         join_room(room_code)
         
@@ -274,15 +500,16 @@ def handle_create_room(username):
             'username': username
         })
         
-        log(f'Room {room_code} created by {username}')
+        logger.info(f'Room {room_code} created by {username}')
 
 
 @socketio.on('join-room')
 def handle_join_room(data):
     sid = request.sid
+    now = time.monotonic_ns()
     
     # Rate limit check
-    is_limited, limit_msg = check_rate_limit(sid)
+    is_limited, limit_msg = check_rate_limit(sid, now)
     if is_limited:
         emit('error', limit_msg)
         return
@@ -312,16 +539,18 @@ def handle_join_room(data):
         emit('error', error)
         return
     
-    with data_lock:
+    # Also hold the lock of the room we may be leaving
+    with user_room_locks(sid, room_code) as current_code:
         # Check room exists
         if room_code not in rooms:
             emit('error', 'Room not found. Check the code and try again.')
             return
         
         room = rooms[room_code]
+        room_code = sys.intern(room_code)
         
         # Check room capacity
-        if len(room['users']) >= MAX_USERS_PER_ROOM:
+        if len(room.users) >= MAX_USERS_PER_ROOM:
             emit('error', f'Room is full (max {MAX_USERS_PER_ROOM} users).')
             return
         
@@ -331,28 +560,27 @@ def handle_join_room(data):
             return
         
         # Leave current room if in one
-        if sid in user_data:
-            handle_user_leave(sid, notify=True)
-        
-        current_time = time.time()
+        if current_code is not None:
+            handle_user_leave(sid, now, notify=True)
+            
+            # Re-joining a room you were alone in deletes it on the way out
+            if rooms.get(room_code) is not room:
+                emit('error', 'Room not found. Check the code and try again.')
+                return
         
         # Get existing users before adding
-        existing_users = list(room['users'].values())
+        existing_users = get_room_roster(room)
         
         # Add user to room
-        room['users'][sid] = {
-            'username': username,
-            'socketId': sid,
-            'muted': False
-        }
-        room['last_activity'] = current_time
+        user = User(sid, username, room_code, now)
+        room.users[sid] = user
+        room.names[username.lower()] = sid
+        room.last_activity = now
         
         # Track user
-        user_data[sid] = {
-            'username': username,
-            'room_code': room_code,
-            'joined_at': current_time
-        }
+        user_data[sid] = user
+        room_members[room_code].add(sid)
+        sid_room[sid] = room_code
         
         join_room(room_code)
         
@@ -363,6 +591,9 @@ def handle_join_room(data):
             'existingUsers': existing_users
         })
         
+        # Extend the cached roster in place now that it has been sent
+        existing_users.append(user.to_payload())
+        
         # Tell existing users about new user
         emit('user-joined', {
             'username': username,
@@ -370,20 +601,21 @@ def handle_join_room(data):
             'muted': False
         }, to=room_code, skip_sid=sid)
         
-        log(f'{username} joined room {room_code} ({len(room["users"])} users)')
+        logger.info(f'{username} joined room {room_code} ({len(room.users)} users)')
 
 
 @socketio.on('leave-room')
 def handle_leave_room():
     sid = request.sid
+    now = time.monotonic_ns()
     
     # Rate limit check
-    is_limited, limit_msg = check_rate_limit(sid)
+    is_limited, limit_msg = check_rate_limit(sid, now)
     if is_limited:
         emit('error', limit_msg)
         return
     
-    handle_user_leave(sid, notify=True)
+    handle_user_leave(sid, now, notify=True)
     emit('left-room', {'success': True})
 
 
@@ -396,18 +628,18 @@ def handle_mute_status(data):
     
     muted = bool(data.get('muted', False))
     
-    with data_lock:
-        if sid not in user_data:
-            return
-        
-        room_code = user_data[sid]['room_code']
-        
-        if room_code and room_code in rooms:
+    room_code = sid_room.get(sid)
+    if room_code is None:
+        return
+    
+    with room_lock(room_code):
+        if room_code in rooms:
             room = rooms[room_code]
             
-            if sid in room['users']:
-                room['users'][sid]['muted'] = muted
-                update_room_activity(room_code)
+            if sid in room.users:
+                room.users[sid].muted = muted
+                room.roster = None
+                update_room_activity(room_code, time.monotonic_ns())
                 
                 # Broadcast to everyone in room
                 emit('user-mute-changed', {
@@ -416,95 +648,48 @@ def handle_mute_status(data):
                 }, to=room_code)
 
 
-@socketio.on('offer')
-def handle_offer(data):
-    sid = request.sid
-    
-    if not data or not isinstance(data, dict):
-        return
-    
-    target_id = data.get('targetId')
-    offer = data.get('offer')
-    
-    if not target_id or not offer:
-        return
-    
-    # Verify sender is in a room
-    if sid not in user_data:
-        return
-    
-    # Verify target exists and is in same room
-    if target_id not in user_data:
-        return
-    
-    if user_data[sid]['room_code'] != user_data[target_id]['room_code']:
-        return
-    
-    emit('offer', {
-        'offer': offer,
-        'fromId': sid,
-        'fromUsername': user_data[sid]['username']
-    }, to=target_id)
-
-
-@socketio.on('answer')
-def handle_answer(data):
-    sid = request.sid
-    
-    if not data or not isinstance(data, dict):
-        return
-    
-    target_id = data.get('targetId')
-    answer = data.get('answer')
-    
-    if not target_id or not answer:
-        return
-    
-    # Verify sender is in a room
-    if sid not in user_data:
-        return
-    
-    # Verify target exists and is in same room
-    if target_id not in user_data:
-        return
-    
-    if user_data[sid]['room_code'] != user_data[target_id]['room_code']:
-        return
+def make_signal_relay(event, field, required=True, with_username=False, forward=None):
+    """Build a handler relaying data[field] to data['targetId'] if both share a room"""
+    # forward(target_id, payload) replaces the direct emit of `event` when given
+    def relay(data):
+        sid = request.sid
+        
+        if not data or not isinstance(data, dict):
+            return
+        
+        target_id = data.get('targetId')
+        value = data.get(field)
+        
+        if not target_id or (required and not value):
+            return
+        
+        # Verify sender and target are in the same room
+        room_code = sid_room.get(sid)
+        if room_code is None or sid_room.get(target_id) is not room_code:
+            return
+        
+        payload = {field: value, 'fromId': sid}
+        
+        if with_username:
+            user = user_data.get(sid)
+            if user is None:
+                return
+            payload['fromUsername'] = user.username
+        
+        if forward is None:
+            emit(event, payload, to=target_id)
+        else:
+            forward(target_id, payload)
     
-    emit('answer', {
-        'answer': answer,
-        'fromId': sid
-    }, to=target_id)
+    relay.__name__ = f'handle_{event.replace("-", "_")}'
+    return relay
 
 
-@socketio.on('ice-candidate')
-def handle_ice_candidate(data):
-    sid = request.sid
-    
-    if not data or not isinstance(data, dict):
-        return
-    
-    target_id = data.get('targetId')
-    candidate = data.get('candidate')
-    
-    if not target_id:
-        return
-    
-    # Verify sender is in a room
-    if sid not in user_data:
-        return
-    
-    # Verify target exists and is in same room
-    if target_id not in user_data:
-        return
-    
-    if user_data[sid]['room_code'] != user_data[target_id]['room_code']:
-        return
-    
-    emit('ice-candidate', {
-        'candidate': candidate,
-        'fromId': sid
-    }, to=target_id)
+handle_offer = socketio.on('offer')(make_signal_relay('offer', 'offer', with_username=True))
+handle_answer = socketio.on('answer')(make_signal_relay('answer', 'answer'))
+# Candidate may be empty (end-of-candidates); coalesced per target, see flush_ice_candidates
+handle_ice_candidate = socketio.on('ice-candidate')(
+    make_signal_relay('ice-candidate', 'candidate', required=False, forward=queue_ice_candidate))
 
 
 @socketio.on('ping-server')
@@ -522,7 +707,7 @@ def handle_get_room_info():
         emit('room-info', {'inRoom': False})
         return
     
-    room_code = user_data[sid]['room_code']
+    room_code = user_data[sid].room_code
     room_info = get_room_info(room_code)
     
     if room_info:
@@ -563,7 +748,11 @@ def health():
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 3000))
-    log(f'Rip Chat Server running on port {port}')
-    log(f'Max users per room: {MAX_USERS_PER_ROOM}')
-    log(f'Max rooms: {MAX_ROOMS}')
-    socketio.run(app, host='0.0.0.0', port=port, debug=False, allow_unsafe_werkzeug=True)
+    logger.info(f'Rip Chat Server running on port {port}')
+    logger.info(f'Max users per room: {MAX_USERS_PER_ROOM}')
+    logger.info(f'Max rooms: {MAX_ROOMS}')
+    logger.info(f'Async mode: {ASYNC_MODE}')
+    if ASYNC_MODE == 'threading':
+        socketio.run(app, host='0.0.0.0', port=port, debug=False, allow_unsafe_werkzeug=True)
+    else:
+        socketio.run(app, host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,46 @@
+import os
+import sys
+import threading
+import unittest
+
+os.environ['ASYNC_MODE'] = 'threading'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import server  # noqa: E402
+
+
+class CleanupInactiveRoomsTest(unittest.TestCase):
+    def setUp(self):
+        server.rooms.clear()
+        server.room_members.clear()
+        server.sid_room.clear()
+        server.room_expiry_heap.clear()
+    
+    def add_room(self, room_code, last_activity):
+        room = server.Room(last_activity, last_activity)
+        room.users['sid1'] = server.User('sid1', 'alice', room_code, last_activity)
+        server.rooms[room_code] = room
+        server.room_members[room_code] = {'sid1'}
+        server.sid_room['sid1'] = room_code
+        server.schedule_room_expiry(room_code, room)
+    
+    def run_cleanup(self, now):
+        worker = threading.Thread(target=server.cleanup_inactive_rooms, args=(now,), daemon=True)
+        worker.start()
+        worker.join(2)
+        self.assertFalse(worker.is_alive(), 'cleanup_inactive_rooms did not return')
+    
+    def test_room_at_exact_timeout_is_kept_without_spinning(self):
+        self.add_room('ABCDEF', 10**12)
+        self.run_cleanup(10**12 + server.ROOM_INACTIVE_TIMEOUT_NS)
+        self.assertIn('ABCDEF', server.rooms)
+    
+    def test_room_past_timeout_is_removed(self):
+        self.add_room('ABCDEF', 10**12)
+        self.run_cleanup(10**12 + server.ROOM_INACTIVE_TIMEOUT_NS + 1)
+        self.assertNotIn('ABCDEF', server.rooms)
+        self.assertNotIn('sid1', server.sid_room)
+
+
+if __name__ == '__main__':
+    unittest.main()